@@ -1,16 +1,61 @@
 from flask import Flask, request, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
+import orjson
 import os
+import tempfile
+import shutil
+import hashlib
+import json
+import time
+import threading
+import re
+import subprocess
+import fcntl
+from contextlib import contextmanager
 from openai import OpenAI
 from PyPDF2 import PdfReader
 from dotenv import load_dotenv
 from pdf2image import convert_from_path
 import pytesseract
+from PIL import Image, ImageOps
 import base64
 from io import BytesIO
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import tiktoken
+import psutil
 from flask_cors import CORS
 
+# Parallelism comes from the OCR process pool; keep each Tesseract single-threaded
+# so OpenMP doesn't multiply threads by the pool size (must be set before tesserocr loads)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+# Optional: in-process Tesseract, avoids spawning a subprocess per page
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
 load_dotenv()
+
+class OrjsonProvider(JSONProvider):
+    """JSON via orjson for jsonify() and request.get_json()"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Write the bytes straight into the response, skipping the intermediate str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
 # Load API key with validation
@@ -25,74 +70,443 @@ else:
 PDF_FOLDER = "uploads"
 os.makedirs(PDF_FOLDER, exist_ok=True)
 
-# ---------- Utility: Extract text (your original) ----------
-def extract_pdf_text(pdf_path):
-    text = ""
+# Case-insensitive .pdf suffix; \Z so a trailing newline doesn't match. The end
+# anchor is also what keeps "<name>.pdf.txt" text sidecars out of /uploads and /chat
+PDF_SUFFIX_RE = re.compile(r"\.pdf\Z", re.IGNORECASE)
+
+SUMMARY_CACHE_FOLDER = "cache"
+os.makedirs(SUMMARY_CACHE_FOLDER, exist_ok=True)
+
+# Bump whenever the summarization prompts change to invalidate cached answers
+PROMPT_VERSION = "2"
+SUMMARY_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
+TEXT_MODEL = "gpt-3.5-turbo"
+VISION_MODEL = "gpt-4o-mini"
+
+SYSTEM_PROMPT = "Bạn là một trợ lý AI hữu ích, luôn tóm tắt tài liệu bằng tiếng Việt, rõ ràng và dễ hiểu, sử dụng gạch đầu dòng."
+
+# Token budget for a single summarization call (gpt-3.5-turbo has a 16k context)
+MAX_SUMMARY_TOKENS = 12000
+# Longer documents are split into chunks of this size and summarized map-reduce style
+SUMMARY_CHUNK_TOKENS = 10000
+# Upper bound on chunks per document; anything beyond is truncated
+MAX_SUMMARY_CHUNKS = 8
+
+# Parsed PDFs (bytes and PdfReader) kept in memory per server process
+PDF_CACHE_SIZE = 8
+
+# Rendered page images keyed by (path, mtime, page number), least recently used evicted
+# first once their decoded size exceeds this budget (~5 A4 pages at 200 DPI, per process)
+PAGE_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+page_image_cache = OrderedDict()
+page_image_cache_lock = threading.Lock()
+
+# Last /uploads listing, reused until the folder's mtime changes
+pdf_listing_cache = {}
+
+# Number of Tesseract processes to run in parallel during OCR; defaults to physical
+# cores since SIMD-bound Tesseract gains nothing from hyperthreads
+OCR_CONCURRENCY = int(os.environ.get(
+    "OCR_CONCURRENCY", psutil.cpu_count(logical=False) or os.cpu_count() or 1
+))
+
+# OCR jobs allowed to run at once across all gunicorn workers on this machine;
+# each job already fans out to OCR_CONCURRENCY Tesseract processes
+OCR_MAX_JOBS = int(os.environ.get("OCR_MAX_JOBS", 1))
+# Lock files backing the OCR slots (flock works across processes and threads)
+OCR_LOCK_DIR = os.environ.get("OCR_LOCK_DIR", tempfile.gettempdir())
+
+# Number of pdftoppm threads used to rasterize pages
+PDF_RENDER_THREADS = max(1, (os.cpu_count() or 1) - 1)
+
+# LSTM engine only, single uniform block of text (skips page layout analysis)
+OCR_CONFIG = os.environ.get("OCR_CONFIG", "--oem 1 --psm 6")
+# Pages larger than this (in pixels, either side) are downscaled before OCR
+OCR_MAX_SIDE = 2500
+# Max pages handed to one worker (and one tesseract invocation) at a time
+OCR_BATCH_SIZE = 50
+
+# OCR workers start from a forkserver instead of fork: request threads may hold
+# locks (e.g. stdout's) at fork time, which would deadlock the child
+ocr_mp_context = multiprocessing.get_context("forkserver")
+ocr_mp_context.set_forkserver_preload([__name__])
+
+# tesserocr engines, one per thread since PyTessBaseAPI is not thread-safe
+ocr_local = threading.local()
+
+# Longest side (in pixels) of the page image sent to the vision model
+VISION_MAX_SIDE = 2048
+
+# ---------- Utility: Filename validation ----------
+def is_pdf_filename(filename):
+    # A bare .pdf name inside PDF_FOLDER; no directory parts (so no traversal)
+    return (
+        os.path.basename(filename) == filename
+        and "\0" not in filename
+        and bool(PDF_SUFFIX_RE.search(filename))
+    )
+
+# ---------- Utility: OCR pages (runs in a worker process) ----------
+def prepare_for_ocr(img):
+    img = ImageOps.autocontrast(img.convert("L"))
+    if max(img.size) > OCR_MAX_SIDE:
+        img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+    return img
+
+def ocr_config_option(flag, default):
+    # Value following e.g. "--psm" or "-l" in OCR_CONFIG, so tesserocr honours the same settings
+    match = re.search(rf"(?:^|\s){flag}\s+(\S+)", OCR_CONFIG)
+    return match.group(1) if match else default
+
+def get_tess_api():
+    # Created once per thread and reused, so the language model is loaded only once
+    api = getattr(ocr_local, "api", None)
+    if api is None:
+        api = PyTessBaseAPI(
+            lang=ocr_config_option("-l", "eng"),
+            psm=int(ocr_config_option("--psm", 3)),
+            oem=int(ocr_config_option("--oem", 3)),
+        )
+        # "-c name=value" overrides, as the tesseract CLI would apply them
+        for name, value in re.findall(r"(?:^|\s)-c\s+([^=\s]+)=(\S+)", OCR_CONFIG):
+            api.SetVariable(name, value)
+        ocr_local.api = api
+    return api
+
+def ocr_image(img):
+    img = prepare_for_ocr(img)
+    if PyTessBaseAPI is None:
+        return pytesseract.image_to_string(img, config=OCR_CONFIG)
+    api = get_tess_api()
+    api.SetImage(img)
+    return api.GetUTF8Text()
+
+def ocr_page_file(path):
+    with Image.open(path) as img:
+        return ocr_image(img)
+
+def ocr_batch(paths):
+    """OCR the page images at the given paths (pdftoppm output), one text per page"""
+    if PyTessBaseAPI is not None:
+        return [ocr_page_file(path) for path in paths]
+
+    # Without tesserocr, OCR the whole batch in a single tesseract run
+    # from a list file instead of one subprocess per page
+    for path in paths:
+        with Image.open(path) as img:
+            prepared = prepare_for_ocr(img)
+        prepared.save(path)
+    with tempfile.TemporaryDirectory() as tmp:
+        list_path = os.path.join(tmp, "pages.txt")
+        with open(list_path, "w") as f:
+            f.write("\n".join(paths) + "\n")
+        try:
+            result = subprocess.run(
+                [pytesseract.pytesseract.tesseract_cmd, list_path, "stdout", *OCR_CONFIG.split()],
+                capture_output=True, check=True
+            )
+        except subprocess.CalledProcessError as e:
+            print(f"⚠️ Batch OCR failed ({e.stderr.decode('utf-8', 'replace').strip()}), retrying page by page...")
+            return [ocr_page_file(path) for path in paths]
+
+    # Pages are separated by form feeds; Tesseract 4 also ends the last page with one
+    texts = result.stdout.decode("utf-8").split("\f")
+    if len(texts) == len(paths) + 1 and texts[-1] == "":
+        texts.pop()
+    if len(texts) != len(paths):
+        print("⚠️ Batch OCR output didn't match page count, retrying page by page...")
+        return [ocr_page_file(path) for path in paths]
+    return texts
+
+@contextmanager
+def ocr_slot():
+    # Take the first free lock file; flock is released automatically if the process dies
+    while True:
+        for i in range(OCR_MAX_JOBS):
+            f = open(os.path.join(OCR_LOCK_DIR, f"ecosummarize-ocr-{i}.lock"), "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+            return
+        time.sleep(0.2)
+
+# ---------- Utility: Cached PDF loading ----------
+@lru_cache(maxsize=PDF_CACHE_SIZE)
+def load_pdf_bytes(path, mtime_ns):
+    with open(path, "rb") as f:
+        return f.read()
+
+@lru_cache(maxsize=PDF_CACHE_SIZE)
+def load_pdf_reader(path, mtime_ns):
+    # A cached reader shares one underlying stream, so it comes with its own lock;
+    # jobs on different PDFs don't wait on each other
+    return PdfReader(BytesIO(load_pdf_bytes(path, mtime_ns))), threading.Lock()
+
+def read_pdf_bytes(path):
+    return load_pdf_bytes(path, os.stat(path).st_mtime_ns)
+
+def get_pdf_reader(path):
+    """Return (reader, lock); hold the lock while reading pages"""
+    # Keyed by mtime so a replaced file is parsed again
+    return load_pdf_reader(path, os.stat(path).st_mtime_ns)
+
+# ---------- Utility: Cached page rendering ----------
+def get_page_image(pdf_path, page_number):
+    # Keyed like load_pdf_bytes, so no hashing of the whole PDF per lookup
+    mtime_ns = os.stat(pdf_path).st_mtime_ns
+    key = (pdf_path, mtime_ns, page_number)
+    with page_image_cache_lock:
+        if key in page_image_cache:
+            page_image_cache.move_to_end(key)
+            return page_image_cache[key]
+
+    image = convert_from_path(pdf_path, first_page=page_number, last_page=page_number)[0]
+    # Decode now: cached images are shared across threads, and a lazy
+    # ImageFile.load() racing in two threads is not safe
+    image.load()
+    with page_image_cache_lock:
+        page_image_cache[key] = image
+        while len(page_image_cache) > 1 and sum(
+            img.width * img.height * len(img.getbands()) for img in page_image_cache.values()
+        ) > PAGE_IMAGE_CACHE_BYTES:
+            page_image_cache.popitem(last=False)
+    return image
+
+# ---------- Utility: Summary cache ----------
+def summary_cache_path(model, pdf_hash):
+    return os.path.join(SUMMARY_CACHE_FOLDER, f"{model}_{PROMPT_VERSION}_{pdf_hash}.json")
+
+def load_cached_summary(model, pdf_hash):
+    cache_path = summary_cache_path(model, pdf_hash)
     try:
-        print(f"🔍 Extracting text from: {pdf_path}")
-        reader = PdfReader(pdf_path)
-        print(f"📄 PDF has {len(reader.pages)} pages")
-        
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-        print(f"✅ Extracted {len(text)} characters with PyPDF2")
+        with open(cache_path, encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() >= entry.get("expiresAt", 0):
+        return None
+    return entry.get("answer")
+
+def save_cached_summary(model, pdf_hash, answer):
+    now = time.time()
+    entry = {
+        "answer": answer,
+        "modelId": model,
+        "createdAt": now,
+        "expiresAt": now + SUMMARY_CACHE_TTL,
+    }
+    try:
+        # Write to a temp file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=SUMMARY_CACHE_FOLDER, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, summary_cache_path(model, pdf_hash))
+    except Exception as e:
+        print(f"⚠️ Could not write summary cache: {e}")
+
+# ---------- Utility: Extracted text sidecar (uploads/<name>.pdf.txt) ----------
+def load_text_sidecar(pdf_path):
+    txt_path = pdf_path + ".txt"
+    try:
+        # Stale once the PDF is replaced with a newer file
+        if os.path.getmtime(txt_path) < os.path.getmtime(pdf_path):
+            return None
+        with open(txt_path, encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def save_text_sidecar(pdf_path, text):
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(pdf_path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, pdf_path + ".txt")
+    except Exception as e:
+        print(f"⚠️ Could not save extracted text: {e}")
+
+# ---------- Utility: PyPDF2 text layer ----------
+def pypdf2_extract(pdf_path):
+    """Return the text of every page ("" for pages without a text layer), or None if parsing fails"""
+    try:
+        reader, reader_lock = get_pdf_reader(pdf_path)
+        with reader_lock:
+            print(f"📄 PDF has {len(reader.pages)} pages")
+
+            page_texts = [page.extract_text() or "" for page in reader.pages]
+        print(f"✅ Extracted {sum(len(t) for t in page_texts)} characters with PyPDF2")
+        return page_texts
     except Exception as e:
         print(f"❌ PyPDF2 extraction failed: {e}")
+        return None
+
+def page_ranges(page_indexes):
+    """Group 0-based page indexes into consecutive 1-based (first, last) ranges"""
+    ranges = []
+    for i in page_indexes:
+        if ranges and ranges[-1][1] == i:
+            ranges[-1][1] = i + 1
+        else:
+            ranges.append([i + 1, i + 1])
+    return ranges
 
-    if not text.strip():
+def render_spans(page_indexes):
+    """1-based (first, last) spans to rasterize so that every given 0-based page is covered"""
+    # Each pdf2image call costs three subprocess launches (pdfinfo, pdftoppm -v, pdftoppm),
+    # so render the whole span in one pass unless most of it has a text layer
+    first, last = page_indexes[0] + 1, page_indexes[-1] + 1
+    if 2 * len(page_indexes) >= last - first + 1:
+        return [[first, last]]
+    return page_ranges(page_indexes)
+
+# ---------- Utility: Extract text (your original) ----------
+def extract_pdf_text(pdf_path, use_saved_text=True):
+    if use_saved_text:
+        cached_text = load_text_sidecar(pdf_path)
+        if cached_text is not None:
+            print(f"⚡ Using saved text for: {pdf_path} ({len(cached_text)} characters)")
+            return cached_text
+
+    print(f"🔍 Extracting text from: {pdf_path}")
+    # Render page 1 to a file speculatively while PyPDF2 runs, so scanned
+    # PDFs don't pay for pdftoppm only after the text layer turns out empty
+    first_page_dir = tempfile.mkdtemp()
+    speculative = ThreadPoolExecutor(max_workers=2)
+    try:
+        text_future = speculative.submit(pypdf2_extract, pdf_path)
+        first_page_future = speculative.submit(
+            convert_from_path, pdf_path, first_page=1, last_page=1,
+            output_folder=first_page_dir, fmt="png", paths_only=True
+        )
+        page_texts = text_future.result()
+    finally:
+        # Don't block on the render if the text layer was good enough
+        speculative.shutdown(wait=False)
+
+    # OCR only the pages without a text layer (all of them if PyPDF2 failed)
+    if page_texts is None:
+        empty_pages = None
+        spans = [[1, None]]
         print("⚠️ No text found, switching to OCR...")
+    else:
+        empty_pages = [i for i, t in enumerate(page_texts) if not t.strip()]
+        spans = render_spans(empty_pages) if empty_pages else []
+        if empty_pages:
+            print(f"⚠️ No text found on {len(empty_pages)} of {len(page_texts)} pages, switching to OCR...")
+
+    ocr_failed = False
+    if spans:
         try:
-            print("🖼️ Converting PDF to images...")
-            images = convert_from_path(pdf_path)
-            print(f"📸 Converted to {len(images)} images")
-            
-            for i, img in enumerate(images):
-                print(f"🔤 Running OCR on image {i+1}...")
-                ocr_text = pytesseract.image_to_string(img)
-                text += ocr_text + "\n"
+            with tempfile.TemporaryDirectory() as tmp:
+                print("🖼️ Converting PDF to images...")
+                # Workers get file paths and load the PNGs themselves, so pixels
+                # are never decoded in this process or pickled to the pool
+                rendered = {}
+                for first, last in spans:
+                    if first == 1:
+                        rendered[1] = first_page_future.result()[0]
+                        first = 2
+                    if last is None or first <= last:
+                        pages = convert_from_path(
+                            pdf_path, first_page=first, last_page=last,
+                            thread_count=PDF_RENDER_THREADS, output_folder=tmp, fmt="png",
+                            paths_only=True
+                        )
+                        for offset, page in enumerate(pages):
+                            rendered[first + offset] = page
+                if empty_pages is None:
+                    page_files = [rendered[n] for n in sorted(rendered)]
+                else:
+                    page_files = [rendered[i + 1] for i in empty_pages]
+                print(f"📸 Converted to {len(page_files)} images")
+
+                workers = max(1, min(OCR_CONCURRENCY, len(page_files)))
+                batch_size = min(OCR_BATCH_SIZE, -(-len(page_files) // workers))
+                batches = [page_files[i:i + batch_size] for i in range(0, len(page_files), batch_size)]
+                # The pool lives only while the slot is held, so at most
+                # OCR_MAX_JOBS * OCR_CONCURRENCY OCR processes exist per machine
+                with ocr_slot(), ProcessPoolExecutor(max_workers=workers, mp_context=ocr_mp_context) as pool:
+                    print(f"🔤 Running OCR on {len(page_files)} images in {len(batches)} batches with {workers} workers...")
+                    ocr_texts = [
+                        text
+                        for batch_texts in pool.map(ocr_batch, batches)
+                        for text in batch_texts
+                    ]
+
+            if empty_pages is None:
+                page_texts = ocr_texts
+            else:
+                for i, ocr_text in zip(empty_pages, ocr_texts):
+                    page_texts[i] = ocr_text
+            for i, ocr_text in enumerate(ocr_texts):
                 print(f"✅ OCR extracted {len(ocr_text)} characters from image {i+1}")
                 
         except Exception as e:
+            ocr_failed = True
             print(f"❌ OCR failed: {e}")
             print(f"❌ Error type: {type(e).__name__}")
             import traceback
             traceback.print_exc()
 
-    final_text = text.strip()
+    # Runs now if the speculative render is done, otherwise as soon as it finishes
+    first_page_future.add_done_callback(
+        lambda _: shutil.rmtree(first_page_dir, ignore_errors=True)
+    )
+
+    parts = [t for t in page_texts or [] if t.strip()]
+    final_text = "\n".join(parts).strip()
     print(f"📝 Final text length: {len(final_text)}")
     if final_text:
         print(f"📄 Preview: {final_text[:200]}...")
+    # Only save complete extractions, so a failed OCR run is retried next time
+    if final_text and not ocr_failed:
+        save_text_sidecar(pdf_path, final_text)
     return final_text
 
+# ---------- Utility: First page as base64 image ----------
+def encode_first_page(pdf_path):
+    print("📷 Converting first page to image...")
+    # Shared with /test-extraction through the page image cache
+    image = get_page_image(pdf_path, 1)
+    print("✅ Converted 1 image")
+
+    print("🖼️ Encoding image to base64...")
+    image = image.convert("RGB")
+    # The vision model re-tiles large images anyway, so send a smaller JPEG
+    image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=85, optimize=True)
+    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    print(f"✅ Base64 encoded, length: {len(img_str)}")
+    return img_str
+
 # ---------- Utility: Vision fallback (your original) ----------
 def summarize_with_vision(pdf_path):
     print(f"👁️ Starting vision processing for: {pdf_path}")
     try:
-        print("📷 Converting first page to image...")
-        images = convert_from_path(pdf_path, first_page=1, last_page=1)
-        print(f"✅ Converted {len(images)} images")
-        
-        print("🖼️ Encoding image to base64...")
-        buffered = BytesIO()
-        images[0].save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        print(f"✅ Base64 encoded, length: {len(img_str)}")
+        img_str = encode_first_page(pdf_path)
 
         print("🤖 Calling GPT-4o vision API...")
         response = client.chat.completions.create(
-            model="gpt-4o-mini",  # Your original model
+            model=VISION_MODEL,  # Your original model
             messages=[
                 {
                     "role": "system",
-                    "content": "Bạn là một trợ lý AI hữu ích, luôn tóm tắt tài liệu bằng tiếng Việt, rõ ràng và dễ hiểu, sử dụng gạch đầu dòng."
+                    "content": SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
                     "content": [
                         {"type": "text", "text": "Hãy tóm tắt trang PDF này bằng tiếng Việt, dùng gạch đầu dòng."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_str}"}}
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_str}"}}
                     ],
                 },
             ],
@@ -107,6 +521,51 @@ def summarize_with_vision(pdf_path):
         traceback.print_exc()
         return None
 
+# ---------- Utility: Token-budgeted text summary ----------
+def complete_summary(prompt):
+    response = client.chat.completions.create(
+        model=TEXT_MODEL,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt},
+        ],
+    )
+    return response.choices[0].message.content
+
+@lru_cache(maxsize=None)
+def get_encoding():
+    # Loaded on first use: tiktoken may download the BPE file, which must not block startup
+    return tiktoken.encoding_for_model(TEXT_MODEL)
+
+def summarize_text(text):
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    print(f"🔢 Text is {len(tokens)} tokens")
+
+    if len(tokens) <= MAX_SUMMARY_TOKENS:
+        return complete_summary(f"Hãy tóm tắt tài liệu PDF này:\n\n{text}")
+
+    # Map: summarize each chunk in parallel
+    max_tokens = SUMMARY_CHUNK_TOKENS * MAX_SUMMARY_CHUNKS
+    if len(tokens) > max_tokens:
+        print(f"✂️ Truncating to {max_tokens} tokens")
+        tokens = tokens[:max_tokens]
+    chunks = [
+        encoding.decode(tokens[i:i + SUMMARY_CHUNK_TOKENS])
+        for i in range(0, len(tokens), SUMMARY_CHUNK_TOKENS)
+    ]
+    print(f"🧩 Summarizing {len(chunks)} chunks...")
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        partials = list(executor.map(
+            lambda chunk: complete_summary(f"Hãy tóm tắt phần này của tài liệu PDF:\n\n{chunk}"),
+            chunks,
+        ))
+
+    # Reduce: summarize the partial summaries
+    combined = "\n\n".join(partials)
+    combined = encoding.decode(encoding.encode(combined)[:MAX_SUMMARY_TOKENS])
+    return complete_summary(f"Hãy tổng hợp các bản tóm tắt sau thành một bản tóm tắt của toàn bộ tài liệu PDF:\n\n{combined}")
+
 # ---------- Routes ----------
 @app.route("/", methods=["GET"])
 def index():
@@ -116,13 +575,18 @@ def index():
 @app.route("/uploads", methods=["GET"])
 def list_pdfs():
     """List all PDF files in the uploads folder"""
-    files = []
     try:
-        for f in os.listdir(PDF_FOLDER):
-            if f.endswith(".pdf"):
-                size_mb = round(os.path.getsize(os.path.join(PDF_FOLDER, f)) / (1024 * 1024), 2)
-                files.append({"filename": f, "size_mb": size_mb})
-        return jsonify(files)
+        # The folder's mtime changes whenever a file is added, removed or renamed
+        mtime = os.stat(PDF_FOLDER).st_mtime_ns
+        if pdf_listing_cache.get("mtime") != mtime:
+            with os.scandir(PDF_FOLDER) as entries:
+                files = [
+                    {"filename": e.name, "size_mb": round(e.stat().st_size / (1024 * 1024), 2)}
+                    for e in entries
+                    if PDF_SUFFIX_RE.search(e.name) and e.is_file()
+                ]
+            pdf_listing_cache.update(mtime=mtime, files=files)
+        return jsonify(pdf_listing_cache["files"])
     except Exception as e:
         return jsonify({"error": f"Could not list files: {str(e)}"}), 500
 
@@ -130,7 +594,12 @@ def list_pdfs():
 def serve_pdf(filename):
     """Serve a specific PDF file"""
     try:
-        return send_from_directory(PDF_FOLDER, filename)
+        # Conditional responses give browsers' PDF viewers Range requests and ETag revalidation
+        response = send_from_directory(
+            PDF_FOLDER, filename, conditional=True, etag=True, max_age=3600
+        )
+        response.headers["Accept-Ranges"] = "bytes"
+        return response
     except Exception as e:
         return jsonify({"error": "File not found"}), 404
 
@@ -161,10 +630,11 @@ def debug():
         debug_info["pytesseract_available"] = True
         debug_info["tesseract_executable_works"] = False
         debug_info["tesseract_error"] = str(e)
+
+    debug_info["tesserocr_available"] = PyTessBaseAPI is not None
     
     # Test poppler (needed for pdf2image)
     try:
-        import subprocess
         result = subprocess.run(['pdftoppm', '-h'], capture_output=True)
         debug_info["poppler_available"] = result.returncode == 0
     except Exception as e:
@@ -176,6 +646,9 @@ def debug():
 @app.route("/test-extraction/<filename>", methods=["GET"])
 def test_extraction(filename):
     """Test each extraction method separately"""
+    if not is_pdf_filename(filename):
+        return jsonify({"error": f"Invalid filename: {filename}"}), 400
+
     pdf_path = os.path.join(PDF_FOLDER, filename)
     if not os.path.exists(pdf_path):
         return jsonify({"error": f"File not found: {filename}"}), 404
@@ -184,12 +657,14 @@ def test_extraction(filename):
     
     # Test PyPDF2
     try:
-        reader = PdfReader(pdf_path)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
+        parts = []
+        reader, reader_lock = get_pdf_reader(pdf_path)
+        with reader_lock:
+            for page in reader.pages:
+                page_text = page.extract_text()
+                if page_text:
+                    parts.append(page_text)
+        text = "\n".join(parts)
         results["pypdf2"] = {
             "success": True,
             "text_length": len(text.strip()),
@@ -200,11 +675,11 @@ def test_extraction(filename):
     
     # Test pdf2image
     try:
-        images = convert_from_path(pdf_path, first_page=1, last_page=1)
+        first_page = get_page_image(pdf_path, 1)
         results["pdf2image"] = {
             "success": True,
-            "images_created": len(images),
-            "image_size": images[0].size if images else None
+            "images_created": 1,
+            "image_size": first_page.size
         }
     except Exception as e:
         results["pdf2image"] = {"success": False, "error": str(e)}
@@ -212,8 +687,8 @@ def test_extraction(filename):
     # Test pytesseract (only if pdf2image worked)
     if results.get("pdf2image", {}).get("success"):
         try:
-            images = convert_from_path(pdf_path, first_page=1, last_page=1)
-            ocr_text = pytesseract.image_to_string(images[0])
+            # pytesseract itself, not the tesserocr path, so the result matches its label
+            ocr_text = pytesseract.image_to_string(prepare_for_ocr(first_page), config=OCR_CONFIG)
             results["pytesseract"] = {
                 "success": True,
                 "text_length": len(ocr_text.strip()),
@@ -233,6 +708,9 @@ def chat():
     if not pdf_filename:
         return jsonify({"error": "No PDF filename provided"}), 400
 
+    if not isinstance(pdf_filename, str) or not is_pdf_filename(pdf_filename):
+        return jsonify({"error": "Invalid filename"}), 400
+
     pdf_path = os.path.join(PDF_FOLDER, pdf_filename)
     if not os.path.exists(pdf_path):
         return jsonify({"error": "File not found"}), 404
@@ -242,29 +720,32 @@ def chat():
 
     try:
         print(f"🚀 Processing: {pdf_filename}")
-        
+
+        # Read once and share the bytes between hashing and PyPDF2; poppler
+        # reads the file on disk directly
+        pdf_bytes = read_pdf_bytes(pdf_path)
+
+        # Step 0: Return a cached summary for identical PDF contents
+        pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        # ?no_cache=1 bypasses both the summary cache and the saved extracted text
+        use_cache = request.args.get("no_cache") != "1"
+        if use_cache:
+            for model in (TEXT_MODEL, VISION_MODEL):
+                cached = load_cached_summary(model, pdf_hash)
+                if cached:
+                    print(f"⚡ Cache hit ({model})")
+                    return jsonify({"answer": cached})
+
         # Step 1: Extract text (your original approach)
-        text = extract_pdf_text(pdf_path)
+        text = extract_pdf_text(pdf_path, use_cache)
 
         if text:
             # Summarize extracted text with GPT-3.5 (your original)
             try:
                 print("🤖 Using GPT-3.5 for text summary...")
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "Bạn là một trợ lý AI hữu ích, luôn tóm tắt tài liệu bằng tiếng Việt, rõ ràng và dễ hiểu, sử dụng gạch đầu dòng."
-                        },
-                        {
-                            "role": "user",
-                            "content": f"Hãy tóm tắt tài liệu PDF này:\\n\\n{text}"
-                        }
-                    ],
-                )
-                answer = response.choices[0].message.content
+                answer = summarize_text(text)
                 print("✅ GPT-3.5 summary completed")
+                save_cached_summary(TEXT_MODEL, pdf_hash, answer)
                 return jsonify({"answer": answer})
             except Exception as e:
                 print(f"❌ GPT-3.5 failed: {e}")
@@ -275,6 +756,7 @@ def chat():
             vision_summary = summarize_with_vision(pdf_path)
             if vision_summary:
                 print("✅ Vision summary completed")
+                save_cached_summary(VISION_MODEL, pdf_hash, vision_summary)
                 return jsonify({"answer": vision_summary})
             else:
                 return jsonify({"error": "Could not extract any text or summarize PDF"}), 500
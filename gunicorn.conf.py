@@ -0,0 +1,10 @@
+import os
+import multiprocessing
+
+# Gunicorn settings for production (used by Procfile and Dockerfile)
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+# OCR and LLM calls can take minutes on large scanned PDFs
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 300))